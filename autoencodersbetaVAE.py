@@ -1,7 +1,5 @@
-import random
 import numpy as np
 import tensorflow as tf
-Normal = tf.contrib.distributions.Normal
 np.random.seed(0)
 tf.set_random_seed(0)
 
@@ -10,15 +8,22 @@ class VariationalAutoencoder(object):
 #https://www-sciencedirect-com.stanford.idm.oclc.org/science/article/pii/S2405896318320949"
 
     def __init__(self, network_architecture, transfer_fct=tf.nn.relu, 
-                 learning_rate=0.001, batch_size=100, istrain=True, restore_path=None, beta=1):
+                 learning_rate=0.001, batch_size=100, istrain=True, restore_path=None, beta=1,
+                 precision='float32', use_xla=True, checkpoint_activations=False):
 
         self.network_architecture = network_architecture
         self.transfer_fct = transfer_fct
         self.learning_rate = learning_rate
         self.batch_size = batch_size
         self.beta=beta
+        # matmuls run in compute_dtype, variables and the loss stay float32
+        self.precision = precision
+        self.compute_dtype = {'float32': tf.float32,
+                              'mixed_float16': tf.float16}[precision]
+        self.use_xla = use_xla
+        self.checkpoint_activations = checkpoint_activations
         
-        self.x = tf.placeholder(tf.float32, [None, network_architecture["n_input"]])
+        self._create_input_pipeline()
         
         self._create_network()
         
@@ -29,99 +34,225 @@ class VariationalAutoencoder(object):
         init = tf.global_variables_initializer()
         
         if istrain:
-            self.sess = tf.InteractiveSession()
+            self.sess = tf.InteractiveSession(config=self._session_config())
             self.sess.run(init)
         else:
-            self.sess=tf.Session()            
+            self.sess=tf.Session(config=self._session_config())            
             self.saver.restore(self.sess, restore_path)
     
+    def _session_config(self):
+
+        config = tf.ConfigProto()
+        # grow GPU memory on demand rather than reserving it all up front
+        config.gpu_options.allow_growth = True
+        if self.use_xla:
+            # XLA auto-clustering fuses the elementwise KL/likelihood ops
+            # between the matmuls; TF1 only auto-clusters GPU ops, so this
+            # is a no-op on CPU-only hosts
+            config.graph_options.optimizer_options.global_jit_level = \
+                tf.OptimizerOptions.ON_1
+        return config
+    
+    def _create_input_pipeline(self):
+        
+        n_input = self.network_architecture["n_input"]
+        # the complete training rows are uploaded once per train() call into
+        # a local (not checkpointed) variable on the default device. The 
+        # pipeline only shuffles and batches row indices, and each batch is 
+        # gathered on-device, so no host memory is copied per training step.
+        self._train_data = tf.placeholder(tf.float32, [None, n_input])
+        self._train_rows = tf.Variable(self._train_data, trainable=False,
+                                       validate_shape=False,
+                                       collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        n_train = tf.shape(self._train_rows, out_type=tf.int64)[0]
+        # shuffle needs a buffer of at least 1 even when no row is complete
+        dataset = tf.data.Dataset.range(n_train) \
+            .shuffle(tf.maximum(n_train, 1)).repeat() \
+            .batch(self.batch_size, drop_remainder=True) \
+            .prefetch(tf.data.experimental.AUTOTUNE)
+        self._train_iterator = dataset.make_initializable_iterator()
+        # x reads from the pipeline unless data is fed explicitly
+        self.x = tf.placeholder_with_default(
+            tf.gather(self._train_rows, self._train_iterator.get_next()),
+            [None, n_input])
+    
     def _create_network(self):
 
-        network_weights = self._initialize_weights(**self.network_architecture)
+        # resource variables (and hence resource Adam slots) can be compiled
+        # by XLA, so the optimizer updates cluster with the gradient ops
+        # instead of running as separate per-variable ApplyAdam kernels
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            network_weights = self._initialize_weights(**self.network_architecture)
 
         self.z_mean, self.z_log_sigma_sq = \
             self._recognition_network(network_weights["weights_recog"], 
                                       network_weights["biases_recog"])
 
-        eps = tf.random_normal(tf.shape(self.z_mean), 0, 1, 
-                               dtype=tf.float32)
+        # latent width is static, only the batch dimension is read at run time.
+        # The stateful op keeps its RNG state on-device across steps; the
+        # explicit op seed makes the noise stream independent of how many
+        # ops were created before it.
+        eps = tf.random_normal([tf.shape(self.z_mean)[0], 
+                                self.network_architecture["n_z"]], 0, 1, 
+                               dtype=self.z_mean.dtype, seed=1)
 
+        # sigma = exp(0.5*log(sigma^2)) in one op instead of sqrt(exp(.))
         self.z = tf.add(self.z_mean, 
-                        tf.multiply(tf.sqrt(tf.exp(self.z_log_sigma_sq)), eps))
+                        tf.multiply(tf.exp(0.5 * self.z_log_sigma_sq), eps))
 
         self.x_hat_mean, self.x_hat_log_sigma_sq = \
             self._generator_network(network_weights["weights_gener"],
                                     network_weights["biases_gener"])
+
+        # sampled reconstruction for reconstruct(sample='sample'); built once
+        # here so that repeated calls do not keep adding ops to the graph.
+        # x_hat_log_sigma_sq is the log of the scale, as in the likelihood.
+        x_hat_eps = tf.random_normal(tf.shape(self.x_hat_mean), 0, 1, 
+                                     dtype=tf.float32, seed=2)
+        self.x_hat_sample = tf.add(self.x_hat_mean, 
+                                   tf.multiply(tf.exp(self.x_hat_log_sigma_sq),
+                                               x_hat_eps))
             
     def _initialize_weights(self, n_hidden_recog_1, n_hidden_recog_2, 
                             n_hidden_gener_1,  n_hidden_gener_2, 
-                            n_input, n_z):
+                            n_input, n_z, n_rank=None):
+        # optionally factor the two widest matrices (input layer of the 
+        # encoder, output heads of the decoder) through an n_rank bottleneck
+        n_recog_in = n_rank or n_input
+        n_gener_out = n_rank or n_hidden_gener_2
         all_weights = dict()
         all_weights['weights_recog'] = {
-            'h1': tf.Variable(xavier_init(n_input, n_hidden_recog_1)),
+            'h1': tf.Variable(xavier_init(n_recog_in, n_hidden_recog_1)),
             'h2': tf.Variable(xavier_init(n_hidden_recog_1, n_hidden_recog_2)),
-            'out_mean': tf.Variable(xavier_init(n_hidden_recog_2, n_z)),
-            'out_log_sigma': tf.Variable(xavier_init(n_hidden_recog_2, n_z))}
+            # mean and log sigma heads share one [n, 2*n_z] matrix (one GEMM)
+            'out': tf.Variable(tf.concat([xavier_init(n_hidden_recog_2, n_z),
+                                          xavier_init(n_hidden_recog_2, n_z)], 1))}
         all_weights['biases_recog'] = {
             'b1': tf.Variable(tf.zeros([n_hidden_recog_1], dtype=tf.float32)),
             'b2': tf.Variable(tf.zeros([n_hidden_recog_2], dtype=tf.float32)),
-            'out_mean': tf.Variable(tf.zeros([n_z], dtype=tf.float32)),
-            'out_log_sigma': tf.Variable(tf.zeros([n_z], dtype=tf.float32))}
+            'out': tf.Variable(tf.zeros([2*n_z], dtype=tf.float32))}
         all_weights['weights_gener'] = {
             'h1': tf.Variable(xavier_init(n_z, n_hidden_gener_1)),
             'h2': tf.Variable(xavier_init(n_hidden_gener_1, n_hidden_gener_2)),
-            'out_mean': tf.Variable(xavier_init(n_hidden_gener_2, n_input)),
-            'out_log_sigma': tf.Variable(xavier_init(n_hidden_gener_2, n_input))}
+            'out': tf.Variable(tf.concat([xavier_init(n_gener_out, n_input),
+                                          xavier_init(n_gener_out, n_input)], 1))}
         all_weights['biases_gener'] = {
             'b1': tf.Variable(tf.zeros([n_hidden_gener_1], dtype=tf.float32)),
             'b2': tf.Variable(tf.zeros([n_hidden_gener_2], dtype=tf.float32)),
-            'out_mean': tf.Variable(tf.zeros([n_input], dtype=tf.float32)),
-            'out_log_sigma': tf.Variable(tf.zeros([n_input], dtype=tf.float32))}
+            'out': tf.Variable(tf.zeros([2*n_input], dtype=tf.float32))}
+        if n_rank:
+            all_weights['weights_recog']['h1_lowrank'] = \
+                tf.Variable(xavier_init(n_input, n_rank))
+            all_weights['weights_gener']['out_lowrank'] = \
+                tf.Variable(xavier_init(n_hidden_gener_2, n_rank))
         return all_weights
             
+    def _affine(self, x, weights, biases, dtype=None):
+        """ x*W + b computed in dtype (the compute dtype by default). The
+            float32 variables are cast on read, so they are never stored in
+            half precision. BiasAdd (rather than Add) lets grappler fuse
+            MatMul+BiasAdd+Relu into a single kernel.
+        """
+        dtype = dtype or self.compute_dtype
+        return tf.nn.bias_add(tf.matmul(tf.cast(x, dtype), tf.cast(weights, dtype)),
+                              tf.cast(biases, dtype))
+            
+    def _lowrank(self, x, weights, dtype=None):
+        """ Bias-free projection into the low-rank bottleneck, if any"""
+        if weights is None:
+            return x
+        dtype = dtype or self.compute_dtype
+        return tf.matmul(tf.cast(x, dtype), tf.cast(weights, dtype))
+            
+    def _checkpointed(self, f, *args):
+        """ Evaluate f(*args). With checkpoint_activations the activations
+            inside f are released after the forward pass and recomputed
+            during backprop. Weights are passed in args so f captures no
+            variables.
+        """
+        if not self.checkpoint_activations:
+            return f(*args)
+        # recompute_grad's gradient takes a `variables` argument; in graph
+        # mode custom_gradient then requires a use_resource=True scope even
+        # though no variables are captured
+        with tf.variable_scope(tf.get_variable_scope(), use_resource=True):
+            return tf.recompute_grad(f)(*args)
+            
     def _recognition_network(self, weights, biases):
 
-        layer_1 = self.transfer_fct(tf.add(tf.matmul(self.x, weights['h1']), 
-                                           biases['b1'])) 
-        layer_2 = self.transfer_fct(tf.add(tf.matmul(layer_1, weights['h2']), 
-                                           biases['b2'])) 
-        z_mean = tf.add(tf.matmul(layer_2, weights['out_mean']),
-                        biases['out_mean'])
-        z_log_sigma_sq = \
-            tf.add(tf.matmul(layer_2, weights['out_log_sigma']), 
-                   biases['out_log_sigma'])
+        x = self._lowrank(self.x, weights.get('h1_lowrank'))
+        layer_1 = self.transfer_fct(self._affine(x, weights['h1'], 
+                                                 biases['b1'])) 
+        
+        def wide_block(layer_1, w2, b2, w_out, b_out):
+            # layer_2 (n_hidden_recog_2 wide) only lives inside this block
+            layer_2 = self.transfer_fct(self._affine(layer_1, w2, b2))
+            # output heads are kept in float32 for the loss
+            return self._affine(layer_2, w_out, b_out, tf.float32)
+        
+        out = self._checkpointed(wide_block, layer_1, weights['h2'], biases['b2'],
+                                 weights['out'], biases['out'])
+        z_mean, z_log_sigma_sq = tf.split(out, 2, axis=1)
         return (z_mean, z_log_sigma_sq)
     
     def _generator_network(self, weights, biases):
 
-        layer_1 = self.transfer_fct(tf.add(tf.matmul(self.z, weights['h1']), 
-                                           biases['b1'])) 
-        layer_2 = self.transfer_fct(tf.add(tf.matmul(layer_1, weights['h2']), 
-                                           biases['b2'])) 
-        x_hat_mean = tf.add(tf.matmul(layer_2, weights['out_mean']),
-                        biases['out_mean'])
-        x_hat_log_sigma_sq = \
-            tf.add(tf.matmul(layer_2, weights['out_log_sigma']), 
-                   biases['out_log_sigma'])
+        def wide_block(z, w1, b1, w2, b2):
+            # layer_1 (n_hidden_gener_1 wide) only lives inside this block
+            layer_1 = self.transfer_fct(self._affine(z, w1, b1))
+            return self.transfer_fct(self._affine(layer_1, w2, b2))
+        
+        layer_2 = self._checkpointed(wide_block, self.z, weights['h1'], biases['b1'],
+                                     weights['h2'], biases['b2'])
+        layer_2 = self._lowrank(layer_2, weights.get('out_lowrank'))
+        out = self._affine(layer_2, weights['out'], biases['out'], tf.float32)
+        x_hat_mean, x_hat_log_sigma_sq = tf.split(out, 2, axis=1)
         
         return (x_hat_mean, x_hat_log_sigma_sq)
             
     def _create_loss_optimizer(self):
         
-        X_hat_distribution = Normal(loc=self.x_hat_mean,
-                                    scale=tf.exp(self.x_hat_log_sigma_sq))
-        reconstr_loss = \
-            -tf.reduce_sum(X_hat_distribution.log_prob(self.x), 1)
+        # Gaussian negative log-likelihood in closed form, with 
+        # x_hat_log_sigma_sq as the log of the scale (as in 
+        # Normal(scale=exp(x_hat_log_sigma_sq))). Using the log scale directly
+        # avoids a divide and a log over the [batch, n_input] output, and the
+        # exp is always taken in float32.
+        x_hat_mean = tf.cast(self.x_hat_mean, tf.float32)
+        x_hat_log_scale = tf.cast(self.x_hat_log_sigma_sq, tf.float32)
+        n_input = self.network_architecture["n_input"]
+        sse = tf.reduce_sum(tf.square(self.x - x_hat_mean) 
+                            * tf.exp(-2.0 * x_hat_log_scale), 1)
+        reconstr_loss = 0.5 * sse + tf.reduce_sum(x_hat_log_scale, 1) \
+                        + 0.5 * n_input * np.log(2 * np.pi)
           
 
-        latent_loss = -0.5 * tf.reduce_sum(1 + self.z_log_sigma_sq 
-                                           - tf.square(self.z_mean) 
-                                           - tf.exp(self.z_log_sigma_sq), 1)
+        # KL term is accumulated in float32 whatever the compute dtype, so 
+        # exp(z_log_sigma_sq) cannot overflow in half precision
+        z_mean = tf.cast(self.z_mean, tf.float32)
+        z_log_sigma_sq = tf.cast(self.z_log_sigma_sq, tf.float32)
+        # single elementwise expression + reduction, which XLA emits as one
+        # fused kernel
+        latent_loss = 0.5 * tf.reduce_sum(tf.exp(z_log_sigma_sq) 
+                                          + tf.square(z_mean) 
+                                          - 1.0 - z_log_sigma_sq, 1)
         self.cost = tf.reduce_mean(reconstr_loss + self.beta *latent_loss)   # average over batch
         self.latent_cost=self.beta *latent_loss
         
-        self.optimizer = \
-            tf.train.AdamOptimizer(learning_rate=self.learning_rate).minimize(self.cost)
+        optimizer = tf.train.AdamOptimizer(learning_rate=self.learning_rate)
+        if self.compute_dtype == tf.float16:
+            # dynamic loss scaling keeps small float16 gradients from underflowing
+            loss_scale_manager = \
+                tf.contrib.mixed_precision.ExponentialUpdateLossScaleManager(2**15, 2000)
+            optimizer = tf.contrib.mixed_precision.LossScaleOptimizer(optimizer,
+                                                                      loss_scale_manager)
+        self.optimizer = optimizer.minimize(self.cost)
+        
+        # running sum of the training cost, kept on-device so train() only 
+        # copies it back to the host at display epochs
+        self._cost_sum = tf.Variable(0.0, trainable=False, use_resource=True,
+                                     collections=[tf.GraphKeys.LOCAL_VARIABLES])
+        self._train_op = tf.group(self.optimizer, 
+                                  self._cost_sum.assign_add(self.cost))
                 
     def fit(self, data):
 
@@ -135,25 +266,27 @@ class VariationalAutoencoder(object):
                                   feed_dict={self.x: data})
         return lc
     
-    def transform_feature(self, data):
+    def _predict(self, fetch, data, batch_size=None):
+        """ Evaluate fetch on data in mini-batches of batch_size rows 
+            (self.batch_size by default) and stack the results. This bounds
+            the memory of the wide hidden activations during imputation.
+        """
+        if len(data) == 0:
+            return self.sess.run(fetch, feed_dict={self.x: data})
+        batch_size = batch_size or self.batch_size
+        return np.concatenate([self.sess.run(fetch, feed_dict={self.x: data[i:i+batch_size]})
+                               for i in range(0, len(data), batch_size)])
+    
+    def transform_feature(self, data, batch_size=None):
 
-        return self.sess.run(self.z_mean, feed_dict={self.x: data})
+        return self._predict(self.z_mean, data, batch_size)
     
-    def reconstruct(self, data, sample = 'mean'):
+    def reconstruct(self, data, sample = 'mean', batch_size=None):
 
         if sample == 'sample':
-            x_hat_mu, x_hat_logsigsq = self.sess.run((self.x_hat_mean, self.x_hat_log_sigma_sq), 
-                             feed_dict={self.x: data})
-        
-            eps = tf.random_normal(tf.shape(data), 1, 
-                               dtype=tf.float32)
-
-            x_hat = tf.add(x_hat_mu, 
-                        tf.multiply(tf.sqrt(tf.exp(x_hat_logsigsq)), eps))
-            x_hat = x_hat.eval()
+            x_hat = self._predict(self.x_hat_sample, data, batch_size)
         else:
-            x_hat_mu = self.sess.run(self.x_hat_mean, 
-                             feed_dict={self.x: data})
+            x_hat_mu = self._predict(self.x_hat_mean, data, batch_size)
             x_hat = x_hat_mu
         
         return x_hat
@@ -182,37 +315,35 @@ class VariationalAutoencoder(object):
     def train(self, data, training_epochs=10, display_step=10):
 
         
-        missing_row_ind = np.where(np.isnan(np.sum(data,axis=1)))
-        n_samples = np.size(data, 0) - missing_row_ind[0].shape[0]
+        non_missing_row_ind = np.where(np.isfinite(np.sum(data,axis=1)))
+        n_samples = non_missing_row_ind[0].shape[0]
+        self.sess.run(self._train_rows.initializer,
+                      feed_dict={self._train_data: data[non_missing_row_ind[0],:]})
+        self.sess.run(self._train_iterator.initializer)
+        # a session callable skips the per-call fetch/feed parsing of
+        # sess.run, which otherwise runs in Python on every training step;
+        # it fetches nothing, so steps do not wait on a device->host copy
+        train_step = self.sess.make_callable(self._train_op)
         
         losshistory = []
         losshistory_epoch = []
         for epoch in range(training_epochs):
-            avg_cost = 0
+            if epoch % display_step == 0:
+                self.sess.run(self._cost_sum.initializer)
             total_batch = int(n_samples / self.batch_size)
             for i in range(total_batch):
-                batch_xs = next_batch(data,self.batch_size)
-                cost = self.fit(batch_xs)
-                lc = self.inspect_latent_cost(batch_xs)
-                avg_cost += cost / n_samples * self.batch_size
+                train_step()
                
             if epoch % display_step == 0:
+                # no complete rows means no steps ran, and the cost stays 0
+                avg_cost = self.sess.run(self._cost_sum) / max(n_samples, 1) * self.batch_size
                 losshistory_epoch.append(epoch)
                 losshistory.append(-avg_cost)
                 print(f'Epoch: {epoch+1:.4f} Cost= {avg_cost:.9f}')
-                #print (lc)
         self.losshistory = losshistory
         self.losshistory_epoch = losshistory_epoch
         return self
 
-def next_batch(data,batch_size):
-
-    non_missing_row_ind = np.where(np.isfinite(np.sum(data,axis=1)))
-    sample_ind = random.sample(list(non_missing_row_ind[0]),batch_size)
-    data_sample = np.copy(data[sample_ind,:])
-    
-    return data_sample
-
 def xavier_init(fan_in, fan_out, constant=1): 
     """ Xavier initialization of network weights"""
     # https://stackoverflow.com/questions/33640581/how-to-do-xavier-initialization-on-tensorflow
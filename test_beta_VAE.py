@@ -6,6 +6,7 @@ import pandas as pd
 import random
 import tensorflow as tf
 import sys
+import os
 import pickle
 from sklearn.decomposition import KernelPCA
 import argparse
@@ -29,7 +30,16 @@ if __name__ == '__main__':
         latent_size = config["latent_size"] #200    
         hidden_size_1=config["hidden_size_1"]
         hidden_size_2=config["hidden_size_2"]
-        beta=config["beta"]   
+        beta=config["beta"]
+        precision = config.get("precision", "float32") # "mixed_float16" on Tensor Core GPUs
+        # optional low-rank bottleneck, e.g. 512; must be the same for training
+        # and testing, otherwise the checkpoint will not restore
+        rank = config.get("rank")
+        # opt-in: let cuBLAS run the float32 matmuls on Tensor Cores with
+        # reduced-precision inputs; must be set before the first session
+        # initialises CUDA, and should match between training and testing
+        if config.get("tensor_op_math_fp32", False):
+            os.environ['TF_ENABLE_CUBLAS_TENSOR_OP_MATH_FP32'] = '1'
             
         data_path =   config["data_path"]     
         corrupt_data_path = config["corrupt_data_path"]
@@ -49,14 +59,14 @@ if __name__ == '__main__':
         na_ind = np.where(np.isnan(data_missing))
         na_count= len(na_ind[0])
        
-        sc = StandardScaler()
-        data_missing_complete = np.copy(data_missing[non_missing_row_ind[0],:])
-        sc.fit(data_missing_complete)
+        # scale in place (copy=False); fitting on the fancy-indexed complete
+        # rows needs no extra np.copy
+        sc = StandardScaler(copy=False)
+        sc.fit(data_missing[non_missing_row_ind[0],:])
         data_missing[na_ind] = 0
         #Scale the testing data with model's trianing data mean and variance
         data_missing = sc.transform(data_missing)
         data_missing[na_ind] = np.nan
-        del data_missing_complete
         data = sc.transform(data)
         
         
@@ -76,18 +86,20 @@ if __name__ == '__main__':
                  n_hidden_gener_1=Decoder_hidden1, # 1st layer decoder neurons
                  n_hidden_gener_2=Decoder_hidden2, # 2nd layer decoder neurons
                  n_input=n_row, # data input size
-                 n_z=latent_size)  # dimensionality of latent space
+                 n_z=latent_size,  # dimensionality of latent space
+                 n_rank=rank) # low-rank factorisation of the widest layers
         
         # initialise VAE:
         vae = VariationalAutoencoder(network_architecture,
                                      learning_rate=learning_rate, 
-                                     batch_size=batch_size,istrain=False,restore_path=rp,beta=beta)
+                                     batch_size=batch_size,istrain=False,restore_path=rp,beta=beta,
+                                     precision=precision)
         
         data_impute = vae.impute(data_corrupt = data_missing, max_iter = ImputeIter)
         
         data = sc.inverse_transform(data)
         data_impute = sc.inverse_transform(data_impute)
-        ReconstructionError = sum(((data_impute[na_ind] - data[na_ind])**2)**0.5)/na_count
+        ReconstructionError = np.sum(np.abs(data_impute[na_ind] - data[na_ind]))/na_count
         print('Reconstruction error (VAE):')
         print(ReconstructionError)
         np.savetxt("./imputed_data_trial_"+str(trial_ind)+"_VAE.csv", data_impute, delimiter=",")  
@@ -6,6 +6,7 @@ import pandas as pd
 import random
 import tensorflow as tf
 import sys
+import os
 import argparse
 import json
 
@@ -24,7 +25,17 @@ if __name__ == '__main__':
         latent_size = config["latent_size"] #200    
         hidden_size_1=config["hidden_size_1"]
         hidden_size_2=config["hidden_size_2"]
-        beta=config["beta"]            
+        beta=config["beta"]
+        precision = config.get("precision", "float32") # "mixed_float16" on Tensor Core GPUs
+        # optional low-rank bottleneck, e.g. 512; must be the same for training
+        # and testing, otherwise the checkpoint will not restore
+        rank = config.get("rank")
+        # opt-in: let cuBLAS run the float32 matmuls on Tensor Cores with
+        # reduced-precision inputs; must be set before the first session
+        # initialises CUDA, and should match between training and testing
+        if config.get("tensor_op_math_fp32", False):
+            os.environ['TF_ENABLE_CUBLAS_TENSOR_OP_MATH_FP32'] = '1'
+        checkpoint_activations = config.get("checkpoint_activations", False) # recompute wide layers in backprop
         data_path =   config["data_path"]     
         corrupt_data_path = config["corrupt_data_path"]
         save_root = config["save_rootpath"]
@@ -37,13 +48,13 @@ if __name__ == '__main__':
         non_missing_row_ind= np.where(np.isfinite(np.sum(data_missing,axis=1)))
         na_ind = np.where(np.isnan(data_missing))
 
-        sc = StandardScaler()
-        data_missing_complete = np.copy(data_missing[non_missing_row_ind[0],:])
-        sc.fit(data_missing_complete)
+        # scale in place (copy=False); fitting on the fancy-indexed complete
+        # rows needs no extra np.copy
+        sc = StandardScaler(copy=False)
+        sc.fit(data_missing[non_missing_row_ind[0],:])
         data_missing[na_ind] = 0
         data_missing = sc.transform(data_missing)
         data_missing[na_ind] = np.nan
-        del data_missing_complete
         data = sc.transform(data)
 
        
@@ -61,13 +72,16 @@ if __name__ == '__main__':
                  n_hidden_gener_1=Decoder_hidden1, # 1st layer decoder neurons
                  n_hidden_gener_2=Decoder_hidden2, # 2nd layer decoder neurons
                  n_input=n_row, # data input size
-                 n_z=latent_size)  # dimensionality of latent space
+                 n_z=latent_size,  # dimensionality of latent space
+                 n_rank=rank) # low-rank factorisation of the widest layers
         
         # initialise VAE:
         vae = VariationalAutoencoder(network_architecture,
                                      learning_rate=learning_rate, 
                                      batch_size=batch_size,istrain=True,restore_path=None,
-                                     beta=beta)
+                                     beta=beta,
+                                     precision=precision,
+                                     checkpoint_activations=checkpoint_activations)
         
         # train VAE on corrupted data:
         vae = vae.train(data=data_missing,